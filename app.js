@@ -14,11 +14,12 @@ const api = require ('./routes')
 const path = require('path')
 const config= require('./config')
 
-const allowedOrigins = config.allowedOrigins;
+// Set of allowed origins, built once so every request is a single lookup
+const allowedOrigins = new Set(config.allowedOrigins);
 
 function setCrossDomain(req, res, next) {
   const origin = req.headers.origin;
-  if (allowedOrigins.includes(origin) || req.method === 'GET' || req.method === 'HEAD'){
+  if (allowedOrigins.has(origin) || req.method === 'GET' || req.method === 'HEAD'){
     res.header('Access-Control-Allow-Origin', origin);
     res.header('Access-Control-Allow-Methods', 'HEAD,GET,PUT,POST,DELETE,OPTIONS');
     res.header('Access-Control-Allow-Headers', 'Content-Type, Authorization, Access-Control-Allow-Origin, Accept, Accept-Language, Origin, User-Agent, x-api-key');
@@ -8,15 +8,20 @@ const path = require('path');
 async function uploadFile(req, res) {
 	let containerName = 'data';
 	if (req.files != null) {
-		var data1 = await saveBlob('data', req.body.url, req.files.thumbnail);
+		// The analysis gets the file bytes directly, so it does not have to wait for the blob upload
+		var [data1, result] = await Promise.all([
+			saveBlob('data', req.body.url, req.files.thumbnail),
+			bookService.form_recognizer(req.body.userId, req.body.docId, containerName, req.body.url, req.files.thumbnail.data)
+		]);
 		if (data1) {
 			const filename = path.basename(req.body.url);
-			console.log(req.body.docId)
-			console.log(req.body.url)
-			console.log(filename)
-			var result = await bookService.form_recognizer(req.body.userId, req.body.docId, containerName, req.body.url)
+			insights.debug(req.body.docId, req.body.url, filename)
 			// var result = await bookService.createBook(req.body.docId, containerName, req.body.url, filename);
 			res.status(200).send(result)
+		} else {
+			// The analysis has already run (and is billed) by now, but without the stored file it is of no use
+			insights.error('Error: the file could not be saved');
+			res.status(500).send({ message: `Error: the file could not be saved` })
 		}
 	} else {
 		insights.error('Error: no files');
@@ -11,40 +11,39 @@ const bookServiceCtrl2 = require('../services/books')
 const docsCtrl = require('../controllers/user/patient/documents')
 const cors = require('cors');
 const serviceEmail = require('../services/email')
+const insights = require('../services/insights')
 
 const api = express.Router()
 const config= require('../config')
 const myApiKey = config.Server_Key;
 // Lista de dominios permitidos
-const whitelist = config.allowedOrigins;
+const whitelist = new Set(config.allowedOrigins);
+
+  // Middleware de CORS para los orígenes permitidos, se crea una sola vez en lugar de en cada petición
+  const corsWhitelisted = cors({ origin: true });
 
   // Middleware personalizado para CORS
   function corsWithOptions(req, res, next) {
-    const corsOptions = {
-      origin: function (origin, callback) {
-        console.log(origin);
-        if (whitelist.includes(origin)) {
-          callback(null, true);
-        } else {
-            // La IP del cliente
-            const clientIp = req.headers['x-forwarded-for'] || req.connection.remoteAddress;
-            const requestInfo = {
-                method: req.method,
-                url: req.url,
-                headers: req.headers,
-                origin: origin,
-                body: req.body, // Asegúrate de que el middleware para parsear el cuerpo ya haya sido usado
-                ip: clientIp,
-                params: req.params,
-                query: req.query,
-              };
-            serviceEmail.sendMailControlCall(requestInfo)
-            callback(new Error('Not allowed by CORS'));
-        }
-      },
-    };
-  
-    cors(corsOptions)(req, res, next);
+    const origin = req.headers.origin;
+    insights.debug(origin);
+    if (whitelist.has(origin)) {
+      corsWhitelisted(req, res, next);
+    } else {
+        // La IP del cliente
+        const clientIp = req.headers['x-forwarded-for'] || req.connection.remoteAddress;
+        const requestInfo = {
+            method: req.method,
+            url: req.url,
+            headers: req.headers,
+            origin: origin,
+            body: req.body, // Asegúrate de que el middleware para parsear el cuerpo ya haya sido usado
+            ip: clientIp,
+            params: req.params,
+            query: req.query,
+          };
+        serviceEmail.sendMailControlCall(requestInfo)
+        next(new Error('Not allowed by CORS'));
+    }
   }
 
   const checkApiKey = (req, res, next) => {
@@ -91,21 +91,20 @@ async function deleteBlobsInFolder(containerName, blobName) {
   return new Promise(async function (resolve, reject) {
     const folderName = blobName.substr(0, blobName.lastIndexOf('/') )
     const containerClient = blobServiceClientGenomics.getContainerClient(containerName);
-    const blobsInFolder = containerClient.listBlobsFlat({ prefix: folderName });
-  
-    const deletePromises = [];
-  
-    for await (const blob of blobsInFolder) {
-      deletePromises.push(deleteBlob(containerName, blob.name));
-    }
 
-    //delete summary files
-    const blobsInFolder2 = containerClient.listBlobsFlat({ prefix: 'raitofile/summary' });
-    for await (const blob2 of blobsInFolder2) {
-      deletePromises.push(deleteBlob(containerName, blob2.name));
+    async function deleteBlobsWithPrefix(prefix) {
+      const deletePromises = [];
+      for await (const blob of containerClient.listBlobsFlat({ prefix: prefix })) {
+        deletePromises.push(deleteBlob(containerName, blob.name));
+      }
+      return Promise.all(deletePromises);
     }
   
-    Promise.all(deletePromises)
+    // The folder and the summary files are independent, both listings run at the same time
+    Promise.all([
+      deleteBlobsWithPrefix(folderName),
+      deleteBlobsWithPrefix('raitofile/summary')
+    ])
       .then((data) => {
         console.log("All blobs in folder deleted");
         resolve(true);
@@ -26,6 +26,15 @@ function error(message) {
   
 }
 
+// Verbose output (full LLM responses, generated html...) is only printed while developing.
+// In production the objects are not even formatted, which saves the inspection and the console output
+function debug(...messages) {
+  if(config.client_server == 'http://localhost:4200'){
+    console.log(...messages)
+  }
+}
+
 module.exports = {
-    error
+    error,
+    debug
 }
\ No newline at end of file
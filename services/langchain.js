@@ -9,6 +9,12 @@ const { ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTempl
 const { BufferMemory, ChatMessageHistory } = require("langchain/memory");
 const { HumanMessage, AIMessage } = require("langchain/schema");
 const countTokens = require( '@anthropic-ai/tokenizer'); 
+const llmcache = require('../services/llmcache');
+// First part of every cache key, bump it whenever a prompt, stop sequence or parser changes
+// so that answers produced under the old ones are not served again
+const llmCacheVersion = 2;
+// Generic information templates, required with the other modules at the top (require caches the parsed JSON either way)
+const genericTemplates = require('./generic_templates.json');
 
 const AZURE_OPENAI_API_KEY = config.OPENAI_API_KEY;
 const AZURE_OPENAI_API_KEY_US = config.OPENAI_API_KEY_US;
@@ -23,99 +29,206 @@ const client = new Client({
 const BEDROCK_API_KEY = config.BEDROCK_USER_KEY;
 const BEDROCK_API_SECRET = config.BEDROCK_USER_SECRET;
 
-function createModels(projectName) {
+function buildModels(projectName) {
   const tracer = new LangChainTracer({
     projectName: projectName,
     client
   });
-  
-  const azuregpt4 = new ChatOpenAI({
-    modelName: "gpt-4-0613",
-    azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
-    azureOpenAIApiVersion: OPENAI_API_VERSION,
-    azureOpenAIApiInstanceName: OPENAI_API_BASE,
-    azureOpenAIApiDeploymentName: "nav29",
-    temperature: 0,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
-  
-  const azure32k = new ChatOpenAI({
-    modelName: "gpt-4-32k-0613",
-    azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
-    azureOpenAIApiVersion: OPENAI_API_VERSION,
-    azureOpenAIApiInstanceName: OPENAI_API_BASE,
-    azureOpenAIApiDeploymentName: "test32k",
-    temperature: 0,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
 
-  const claude2 = new ChatBedrock({
-    model: "anthropic.claude-v2",
-    region: "eu-central-1",
-    endpointUrl: "bedrock-runtime.eu-central-1.amazonaws.com",
-    credentials: {
-       accessKeyId: BEDROCK_API_KEY,
-       secretAccessKey: BEDROCK_API_SECRET,
-    },
-    temperature: 0,
-    maxTokens: 8191,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
+  // invokeWithBackoff is the only retry policy, so the models do not retry on their own (maxRetries: 0)
+  // Each model is only built the first time a caller reads it, a request uses one or two of them
+  const factories = {
+    azuregpt4: () => new ChatOpenAI({
+      modelName: "gpt-4-0613",
+      azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
+      azureOpenAIApiVersion: OPENAI_API_VERSION,
+      azureOpenAIApiInstanceName: OPENAI_API_BASE,
+      azureOpenAIApiDeploymentName: "nav29",
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+
+    azure32k: () => new ChatOpenAI({
+      modelName: "gpt-4-32k-0613",
+      azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
+      azureOpenAIApiVersion: OPENAI_API_VERSION,
+      azureOpenAIApiInstanceName: OPENAI_API_BASE,
+      azureOpenAIApiDeploymentName: "test32k",
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+
+    claude2: () => new ChatBedrock({
+      model: "anthropic.claude-v2",
+      region: "eu-central-1",
+      endpointUrl: "bedrock-runtime.eu-central-1.amazonaws.com",
+      credentials: {
+         accessKeyId: BEDROCK_API_KEY,
+         secretAccessKey: BEDROCK_API_SECRET,
+      },
+      temperature: 0,
+      maxTokens: 8191,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+
+    model128k: () => new ChatOpenAI({
+      modelName: "gpt-4-1106-preview",
+      openAIApiKey: OPENAI_API_KEY,
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+
+    azure128k: () => new ChatOpenAI({
+      azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
+      azureOpenAIApiVersion: OPENAI_API_VERSION,
+      azureOpenAIApiInstanceName: OPENAI_API_BASE,
+      azureOpenAIApiDeploymentName: "nav29turbo",
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+
+    // Same deployment as azure128k, but the API guarantees a JSON object as the response
+    azure128kJson: () => new ChatOpenAI({
+      azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
+      azureOpenAIApiVersion: OPENAI_API_VERSION,
+      azureOpenAIApiInstanceName: OPENAI_API_BASE,
+      azureOpenAIApiDeploymentName: "nav29turbo",
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      modelKwargs: { response_format: { type: "json_object" } },
+      callbacks: [tracer],
+    }),
+
+    azuregpt4o: () => new ChatOpenAI({
+      azureOpenAIApiKey: AZURE_OPENAI_API_KEY_US,
+      azureOpenAIApiVersion: OPENAI_API_VERSION,
+      azureOpenAIApiInstanceName: OPENAI_API_BASE_US,
+      azureOpenAIApiDeploymentName: "gpt-4o",
+      temperature: 0,
+      timeout: 500000,
+      maxRetries: 0,
+      callbacks: [tracer],
+    }),
+  };
+
+  const models = {};
+  for (const name of Object.keys(factories)) {
+    let model = null;
+    Object.defineProperty(models, name, {
+      enumerable: true,
+      get: () => model || (model = factories[name]()),
+    });
+  }
+  return models;
+}
 
-  const model128k = new ChatOpenAI({
-    modelName: "gpt-4-1106-preview",
-    openAIApiKey: OPENAI_API_KEY,
-    temperature: 0,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
+// The server is long-lived, so the models of each LangSmith project (one per user) are kept between requests
+// and reuse their clients and connections. The least recently used projects are dropped past the limit
+const maxModelSets = 100;
+const modelSets = new Map();
 
-  const azure128k = new ChatOpenAI({
-    azureOpenAIApiKey: AZURE_OPENAI_API_KEY,
-    azureOpenAIApiVersion: OPENAI_API_VERSION,
-    azureOpenAIApiInstanceName: OPENAI_API_BASE,
-    azureOpenAIApiDeploymentName: "nav29turbo",
-    temperature: 0,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
+function createModels(projectName) {
+  let models = modelSets.get(projectName);
+  if (models) {
+    modelSets.delete(projectName);
+  } else {
+    models = buildModels(projectName);
+  }
+  modelSets.set(projectName, models);
+  if (modelSets.size > maxModelSets) {
+    modelSets.delete(modelSets.keys().next().value);
+  }
+  return models;
+}
 
-  const azuregpt4o = new ChatOpenAI({
-    azureOpenAIApiKey: AZURE_OPENAI_API_KEY_US,
-    azureOpenAIApiVersion: OPENAI_API_VERSION,
-    azureOpenAIApiInstanceName: OPENAI_API_BASE_US,
-    azureOpenAIApiDeploymentName: "gpt-4o",
-    temperature: 0,
-    timeout: 500000,
-    callbacks: [tracer],
-  });
-  
-  return { azuregpt4, azure32k, claude2, model128k, azure128k, azuregpt4o };
+// Every tagged section of a response is read in a single pass, the first occurrence of each tag wins
+const taggedSectionRegex = /<(html|output)>(.*?)<\/\1>/gs;
+
+function extractTaggedSections(summaryText) {
+  const sections = {};
+  for (const match of summaryText.matchAll(taggedSectionRegex)) {
+    if (!(match[1] in sections)) {
+      sections[match[1]] = match[2];
+    }
+  }
+  return sections;
 }
 
-function extractAndParse(summaryText) {
-  // Step 1: Extract Text using Regular Expressions
-  const matches = summaryText.match(/<output>(.*?)<\/output>/s);
-  if (!matches) {
-    console.warn("No matches found in <output> tags.");
+const invalidJsonResult = "Invalid JSON format";
+
+// extractAndParse answers "[]" or invalidJsonResult when it cannot read the tag, such answers are not cached
+function isParsedOutput(sections, tag, text) {
+  return tag in sections && text !== invalidJsonResult;
+}
+
+function extractAndParse(sections, tag = 'output') {
+  // Step 1: Take the text of the tag
+  if (!(tag in sections)) {
+    console.warn(`No matches found in <${tag}> tags.`);
     return "[]";
   }
 
   // Assuming the content in <output> is JSON
   try {
     // Step 2: Convert Extracted Text to JSON
-    const extractedJson = JSON.parse(matches[1]);  // Considering only the first match
+    const extractedJson = JSON.parse(sections[tag]);
     return JSON.stringify(extractedJson);
   } catch (error) {
-    console.warn("Invalid JSON format in <output> tags.");
-    return "Invalid JSON format";
+    console.warn(`Invalid JSON format in <${tag}> tags.`);
+    return invalidJsonResult;
+  }
+}
+
+// <EMPTY_x> placeholders of the summary html: JSON variable (and templates group) that fills each one and its div title
+const htmlPlaceholders = {
+  genetic_technique: { variable: 'genetic_technique', title: 'Genetic Technique' },
+  pathogenic_variants: { variable: 'pathogenic_variants', title: 'Pathogenic Variants' },
+  heritage: { variable: 'genetic_heritage', title: 'Genetic Heritage' },
+  paternal_tests_confirmation: { variable: 'paternal_tests_confirmation', title: 'Paternal Tests Confirmation' }
+};
+const htmlPlaceholderRegex = /<EMPTY_(genetic_technique|pathogenic_variants|heritage|paternal_tests_confirmation)>/g;
+
+// The model writes the values in free form ("autosomal dominant", "X-linked recessive", true...),
+// so each templates group is indexed once by a normalized key
+function normalizeTemplateKey(value) {
+  return String(value).toLowerCase().replace(/[^a-z0-9]/g, '').replace(/inheritance$/, '');
+}
+
+// A malformed generic_templates.json fails at startup instead of in the middle of a summary
+for (const placeholder of Object.values(htmlPlaceholders)) {
+  const group = genericTemplates[placeholder.variable];
+  if (!group || typeof group !== 'object' || Array.isArray(group)) {
+    throw new Error(`generic_templates.json is missing the ${placeholder.variable} group`);
+  }
+  for (const key of Object.keys(group)) {
+    if (typeof group[key] !== 'string') {
+      throw new Error(`generic_templates.json: ${placeholder.variable}.${key} must be an html string`);
+    }
+  }
+}
+
+const genericTemplatesIndex = {};
+for (const group of Object.keys(genericTemplates)) {
+  genericTemplatesIndex[group] = {};
+  for (const key of Object.keys(genericTemplates[group])) {
+    genericTemplatesIndex[group][normalizeTemplateKey(key)] = genericTemplates[group][key];
   }
+  Object.freeze(genericTemplatesIndex[group]);
 }
+Object.freeze(genericTemplatesIndex);
 
-function createHtmlTemplate(htmlContent, jsonContent) {
+function createHtmlTemplate(htmlContent, jsonObject) {
   // Based on the JSON variables, we will edit the htmlContent and return the new html
   // Each variable will control some part of the htmlContent
   /* Example of JSON vars:
@@ -153,58 +266,46 @@ function createHtmlTemplate(htmlContent, jsonContent) {
     </html>
   */
     
-  // Step 1: Convert JSON to Object
-  const jsonObject = JSON.parse(jsonContent);
-  // We will load a JSON with the generic information templates
-  const genericTemplates = require('./generic_templates.json');
-
-  // Step 2: Add the new divs to the htmlContent based on the jsonObject
-  if (jsonObject.genetic_technique) {
-    const geneticTechnique = genericTemplates.genetic_technique[jsonObject.genetic_technique];
-    htmlContent = htmlContent.replace(/<EMPTY_genetic_technique>/g, `<div title="Genetic Technique">${geneticTechnique}</div><br/>`);
+  // Step 1: The JSON comes already parsed by extractAndParseGene, a string here is one of its error results
+  if (typeof jsonObject === 'string') {
+    throw new Error("Invalid JSON format in <output> tags.");
   }
 
-  if (jsonObject.pathogenic_variants) {
-    const pathogenicVariants = genericTemplates.pathogenic_variants[jsonObject.pathogenic_variants];
-      htmlContent = htmlContent.replace(/<EMPTY_pathogenic_variants>/g, `<div title="Pathogenic Variants">${pathogenicVariants}</div><br/>`);
-  }
-
-  if (jsonObject.genetic_heritage) {
-    const geneticHeritage = genericTemplates.genetic_heritage[jsonObject.genetic_heritage];
-    htmlContent = htmlContent.replace(/<EMPTY_heritage>/g, `<div title="Genetic Heritage">${geneticHeritage}</div><br/>`);
-  } 
-
-  if (jsonObject.paternal_tests_confirmation) {
-    const paternalTestsConfirmation = genericTemplates.paternal_tests_confirmation[jsonObject.paternal_tests_confirmation];
-    htmlContent = htmlContent.replace(/<EMPTY_paternal_tests_confirmation>/g, `<div title="Paternal Tests Confirmation">${paternalTestsConfirmation}</div><br/>`);
-  }
+  // Step 2: Add the new divs to the htmlContent based on the jsonObject, all placeholders in one pass
+  htmlContent = htmlContent.replace(htmlPlaceholderRegex, (match, name) => {
+    const placeholder = htmlPlaceholders[name];
+    const value = jsonObject[placeholder.variable];
+    const template = value ? genericTemplatesIndex[placeholder.variable][normalizeTemplateKey(value)] : undefined;
+    if (!template) {
+      return match;
+    }
+    return `<div title="${placeholder.title}">${template}</div><br/>`;
+  });
 
   // Step 3: Return the new htmlContent
-  console.log(htmlContent);
+  insights.debug(htmlContent);
 
   return [htmlContent, jsonObject.pathogenic_variants_list];
 }
 
-function extractAndParseGene(summaryText) {
-  // Step 1: Extract Text using Regular Expressions
-  const matchHtml = summaryText.match(/<html>(.*?)<\/html>/s);
-  const matches = summaryText.match(/<output>(.*?)<\/output>/s);
-  if (!matchHtml) {
+function extractAndParseGene(sections) {
+  // Step 1: Take the text of the html and output tags
+  if (!('html' in sections)) {
     console.warn("No matches found in <html> tags.");
     return "[]";
   }
 
-  if (!matches) {
+  if (!('output' in sections)) {
     console.warn("No matches found in <output> tags.");
     return "[]";
   }
 
   // Assuming the content in <output> is JSON
   try {
-    // Step 2: Convert Extracted Text to JSON
-    const extractedHtml = matchHtml[1];  // Considering only the first match
-    const extractedJson = JSON.parse(matches[1]);  // Considering only the first match
-    return [extractedHtml, JSON.stringify(extractedJson)];
+    // Step 2: Convert Extracted Text to JSON, handed to createHtmlTemplate as an object
+    const extractedHtml = sections.html;
+    const extractedJson = JSON.parse(sections.output);
+    return [extractedHtml, extractedJson];
   } catch (error) {
     console.warn("Invalid JSON format in <output> tags.");
     return "Invalid JSON format";
@@ -212,35 +313,60 @@ function extractAndParseGene(summaryText) {
 }
 
 
-// This function will be a basic conversation with documents (context)
-async function navigator_chat(userId, question, conversation, context){
-  return new Promise(async function (resolve, reject) {
+// With a stop sequence the API returns the text without it, put the closing tag back for the parsers
+function restoreStopSequence(text, stopSequence) {
+  return text.includes(stopSequence) ? text : text + stopSequence;
+}
+
+// Rate limits (429), 5xx responses and connection errors or timeouts are retried with exponential backoff
+// and jitter, any other error is not going to succeed on retry and is thrown straight away
+// The openai client raises APIConnectionError / APIConnectionTimeoutError without a status,
+// and langchain renames the timeout to TimeoutError
+const transientErrorNames = new Set(['APIConnectionError', 'APIConnectionTimeoutError', 'TimeoutError']);
+
+function isTransientError(error) {
+  if (transientErrorNames.has(error.name) || transientErrorNames.has(error.constructor && error.constructor.name)) {
+    return true;
+  }
+  const status = error.status || (error.response && error.response.status) || (error.$metadata && error.$metadata.httpStatusCode);
+  if (status) {
+    return status == 429 || status >= 500;
+  }
+  return /Error 429|ECONNRESET|ETIMEDOUT|socket hang up|Connection error|Request timed out|fetch failed/.test(error.message || '');
+}
+
+async function invokeWithBackoff(chain, input, maxAttempts = 4) {
+  for (let attempt = 1; ; attempt++) {
     try {
-      // Create the models
-      const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
-  
-      // Format and call the prompt
-      let cleanPatientInfo = "";
-      let i = 1;
-      for (const doc of context) {
-        let docText = JSON.stringify(doc);
-        cleanPatientInfo += "<Complete Document " + i + ">\n" + docText + "</Complete Document " + i + ">\n";
-        i++;
+      return await chain.invoke(input);
+    } catch (error) {
+      if (attempt >= maxAttempts || !isTransientError(error)) {
+        throw error;
       }
-      
-      cleanPatientInfo = cleanPatientInfo.replace(/{/g, '{{').replace(/}/g, '}}');
+      const delay = 2000 * Math.pow(2, attempt - 1) + Math.floor(Math.random() * 1000);
+      console.log(`Transient error (attempt ${attempt}), retrying in ${delay} ms...`);
+      await new Promise(resolve => setTimeout(resolve, delay));
+    }
+  }
+}
 
-      const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
-        `This is the list of the medical information of the patient:
-  
-        ${cleanPatientInfo}
-  
-        You are a medical expert, based on this context with the medical documents from the patient.`
-      );
-  
-      const humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-        `Take a deep breath and work on this problem step-by-step.      
+// Braces are doubled so the prompt templates keep them as literal text, both kinds in a single pass
+const templateBracesRegex = /[{}]/g;
+
+function escapeTemplateBraces(text) {
+  return text.replace(templateBracesRegex, brace => brace + brace);
+}
+
+function formatPatientContext(context) {
+  // Each document is formatted on its own and the pieces are joined once at the end
+  return escapeTemplateBraces(context.map((doc, index) =>
+    `<Complete Document ${index + 1}>\n${JSON.stringify(doc)}</Complete Document ${index + 1}>\n`
+  ).join(''));
+}
+
+
+const chatHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Take a deep breath and work on this problem step-by-step.      
         Please, answer the following question/task with the information you have in context:
   
         <input>
@@ -259,8 +385,29 @@ async function navigator_chat(userId, question, conversation, context){
         <output example>
         <div><h3>Example Title</h3><table border='1'><tr><th>Category 1</th><td>Details for category 1</td></tr><tr><th>Category 2</th><td>Details for category 2</td></tr></table><p>Additional information or summary here.</p></div>
         </output example>`
+);
+
+// This function will be a basic conversation with documents (context)
+async function navigator_chat(userId, question, conversation, context){
+  return new Promise(async function (resolve, reject) {
+    try {
+      // Create the models
+      const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
+      let { azure128k } = createModels(projectName);
+  
+      // Format and call the prompt
+      let cleanPatientInfo = formatPatientContext(context);
+
+      const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
+        `This is the list of the medical information of the patient:
+  
+        ${cleanPatientInfo}
+  
+        You are a medical expert, based on this context with the medical documents from the patient.`
       );
   
+      const humanMessagePrompt = chatHumanPrompt;
+  
       const chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, new MessagesPlaceholder("history"), humanMessagePrompt]);
      
       const pastMessages = [];      
@@ -289,27 +436,9 @@ async function navigator_chat(userId, question, conversation, context){
         llm: azure128k,
       });
 
-      const chain_retry = chain.withRetry({
-        stopAfterAttempt: 3,
+      let response = await invokeWithBackoff(chain, {
+        input: question,
       });
-
-      
-      let response;
-      try {
-        response = await chain_retry.invoke({
-          input: question,
-        });
-      } catch (error) {
-        if (error.message.includes('Error 429')) {
-          console.log("Rate limit exceeded, waiting and retrying...");
-          await new Promise(resolve => setTimeout(resolve, 20000)); // Wait for 20 seconds
-          response = await chain_retry.invoke({
-            input: question,
-          });
-        } else {
-          throw error;
-        }
-      }
   
       // console.log(response);
       resolve(response);
@@ -326,39 +455,8 @@ async function navigator_chat(userId, question, conversation, context){
 }
 
 
-// This function will be a basic conversation with documents (context)
-// This will take some history of the conversation if any and the current documents if any
-// And will return a proper answer to the question based on the conversation and the documents 
-async function navigator_summarize(userId, question, context, timeline, gene){
-  return new Promise(async function (resolve, reject) {
-    try {
-      // Create the models
-      const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
-  
-      // Format and call the prompt
-      let cleanPatientInfo = "";
-      let i = 1;
-      for (const doc of context) {
-        let docText = JSON.stringify(doc);
-        cleanPatientInfo += "<Complete Document " + i + ">\n" + docText + "</Complete Document " + i + ">\n";
-        i++;
-      }
-      
-      cleanPatientInfo = cleanPatientInfo.replace(/{/g, '{{').replace(/}/g, '}}');
-
-      const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
-        `This is the list of the medical information of the patient:
-  
-        ${cleanPatientInfo}
-  
-        You are a medical expert, based on this context with the medical documents from the patient.`
-      );
-  
-      let humanMessagePrompt;
-      if (timeline) {
-        humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-          `Take a deep breath and work on this problem step-by-step.      
+const summarizeTimelineHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Take a deep breath and work on this problem step-by-step.      
           Please, answer the following question/task with the information you have in context:
 
           <input>
@@ -391,10 +489,10 @@ async function navigator_summarize(userId, question, context, timeline, gene){
           </output>
           
           Always use the <output> tag to encapsulate the JSON response.`
-        );
-      } else if (gene) {
-        humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-          `Take a deep breath and work on this problem step-by-step.      
+);
+
+const summarizeGeneHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Take a deep breath and work on this problem step-by-step.      
           Please, answer the following question/task with the information you have in context:
 
           <input>
@@ -450,47 +548,89 @@ async function navigator_summarize(userId, question, context, timeline, gene){
           </output>
           
           Always use the <output> tag to encapsulate the JSON response.`
-        );
+);
+
+// Each summarize mode: its human prompt, where generation can stop and how the answer is parsed.
+// parse tells whether the answer was read correctly (and can be cached)
+const summarizeModes = {
+  timeline: {
+    humanPrompt: summarizeTimelineHumanPrompt,
+    stop: '</output>',
+    parse: (response, sections) => {
+      response.text = extractAndParse(sections);
+      return isParsedOutput(sections, 'output', response.text);
+    }
+  },
+  gene: {
+    humanPrompt: summarizeGeneHumanPrompt,
+    stop: undefined,
+    parse: (response, sections) => {
+      const parts = extractAndParseGene(sections);
+      const formattedParts = createHtmlTemplate(parts[0], parts[1]);
+      response.text = formattedParts[0];
+      response.json = formattedParts[1];
+      return true;
+    }
+  }
+};
+
+// This function will be a basic conversation with documents (context)
+// This will take some history of the conversation if any and the current documents if any
+// And will return a proper answer to the question based on the conversation and the documents 
+async function navigator_summarize(userId, question, context, timeline, gene){
+  return new Promise(async function (resolve, reject) {
+    try {
+      // Create the models
+      const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
+      let { azuregpt4o } = createModels(projectName);
+  
+      // Format and call the prompt
+      let cleanPatientInfo = formatPatientContext(context);
+
+      const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
+        `This is the list of the medical information of the patient:
+  
+        ${cleanPatientInfo}
+  
+        You are a medical expert, based on this context with the medical documents from the patient.`
+      );
+  
+      const mode = timeline ? summarizeModes.timeline : (gene ? summarizeModes.gene : undefined);
+      if (!mode) {
+        throw new Error("navigator_summarize needs either timeline or gene");
       }
   
-      const chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, humanMessagePrompt]);
+      const chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, mode.humanPrompt]);
   
+      // When the answer is complete at a closing tag, stop generating there instead of letting the model go on
       const chain = new LLMChain({
         prompt: chatPrompt,
         llm: azuregpt4o,
+        llmKwargs: mode.stop ? { stop: [mode.stop] } : undefined,
       });
 
-      const chain_retry = chain.withRetry({
-        stopAfterAttempt: 3,
-      });
-
+      // Same question over the same documents returns the stored answer (temperature is 0)
+      const cacheKey = llmcache.getKey([llmCacheVersion, 'navigator_summarize', 'gpt-4o', question, cleanPatientInfo, timeline, gene]);
+      const cachedText = await llmcache.get(cacheKey);
       
       let response;
-      try {
-        response = await chain_retry.invoke({
+      if (cachedText !== null) {
+        response = { text: cachedText };
+      } else {
+        response = await invokeWithBackoff(chain, {
           input: question,
         });
-      } catch (error) {
-        if (error.message.includes('Error 429')) {
-          console.log("Rate limit exceeded, waiting and retrying...");
-          await new Promise(resolve => setTimeout(resolve, 20000)); // Wait for 20 seconds
-          response = await chain_retry.invoke({
-            input: question,
-          });
-        } else {
-          throw error;
+        if (mode.stop) {
+          response.text = restoreStopSequence(response.text, mode.stop);
         }
       }
 
-      console.log(response);
+      insights.debug(response);
 
-      if (timeline) {
-        response.text = extractAndParse(response.text);
-      } else if (gene) {
-        parts = extractAndParseGene(response.text);
-        formattedParts = createHtmlTemplate(parts[0], parts[1]);
-        response.text = formattedParts[0];
-        response.json = formattedParts[1];
+      // Only answers that parse are cached, a malformed one is generated again on the next request
+      const rawText = response.text;
+      if (mode.parse(response, extractTaggedSections(rawText)) && cachedText === null) {
+        await llmcache.set(cacheKey, rawText);
       }
 
       resolve(response);
@@ -512,18 +652,10 @@ async function navigator_summarizeTranscript(userId, question, conversation, con
     try {
       // Create the models
       const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
+      let { azure128k } = createModels(projectName);
   
       // Format and call the prompt
-      let cleanPatientInfo = "";
-      let i = 1;
-      for (const doc of context) {
-        let docText = JSON.stringify(doc);
-        cleanPatientInfo += "<Complete Document " + i + ">\n" + docText + "</Complete Document " + i + ">\n";
-        i++;
-      }
-      
-      cleanPatientInfo = cleanPatientInfo.replace(/{/g, '{{').replace(/}/g, '}}');
+      let cleanPatientInfo = formatPatientContext(context);
 
       const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
         `This is the list of the medical information of the patient:
@@ -583,27 +715,9 @@ async function navigator_summarizeTranscript(userId, question, conversation, con
         llm: azure128k,
       });
 
-      const chain_retry = chain.withRetry({
-        stopAfterAttempt: 3,
+      let response = await invokeWithBackoff(chain, {
+        input: question,
       });
-
-      
-      let response;
-      try {
-        response = await chain_retry.invoke({
-          input: question,
-        });
-      } catch (error) {
-        if (error.message.includes('Error 429')) {
-          console.log("Rate limit exceeded, waiting and retrying...");
-          await new Promise(resolve => setTimeout(resolve, 20000)); // Wait for 20 seconds
-          response = await chain_retry.invoke({
-            input: question,
-          });
-        } else {
-          throw error;
-        }
-      }
   
       // console.log(response);
       resolve(response);
@@ -620,23 +734,28 @@ async function navigator_summarizeTranscript(userId, question, conversation, con
 }
 
 
+const dxHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `List all the symptoms from the patient's medical report in a single, concise paragraph, starting immediately with the first symptom, do not include any introductory phrases or additional explanations
+
+    <input>
+    {input}
+    </input>
+
+    Guidelines:
+    - Begin directly with the first symptom. Example: 'Headache, fever, joint pain...'
+    - Compile all symptoms into one continuous paragraph.
+    - Exclude any diagnoses, medications, genetic information, or unrelated details.`
+);
+
 async function navigator_summarize_dx(userId, question, conversation, context){
   return new Promise(async function (resolve, reject) {
     try {
       // Create the models
       const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
+      let { claude2 } = createModels(projectName);
   
       // Format and call the prompt
-      let cleanPatientInfo = "";
-      let i = 1;
-      for (const doc of context) {
-        let docText = JSON.stringify(doc);
-        cleanPatientInfo += "<Complete Document " + i + ">\n" + docText + "</Complete Document " + i + ">\n";
-        i++;
-      }
-      
-      cleanPatientInfo = cleanPatientInfo.replace(/{/g, '{{').replace(/}/g, '}}');
+      let cleanPatientInfo = formatPatientContext(context);
 
       /*const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
         `Symptom-Only Summary:
@@ -684,18 +803,7 @@ async function navigator_summarize_dx(userId, question, conversation, context){
       - Avoid including any diagnoses, medications, genetic information, or unrelated details.`
   );*/
 
-  const humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-    `List all the symptoms from the patient's medical report in a single, concise paragraph, starting immediately with the first symptom, do not include any introductory phrases or additional explanations
-
-    <input>
-    {input}
-    </input>
-
-    Guidelines:
-    - Begin directly with the first symptom. Example: 'Headache, fever, joint pain...'
-    - Compile all symptoms into one continuous paragraph.
-    - Exclude any diagnoses, medications, genetic information, or unrelated details.`
-);
+  const humanMessagePrompt = dxHumanPrompt;
   /*const humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
   `List the symptoms from the patient's medical report starting immediately with the first symptom. The summary should be in plain text, without HTML formatting, and should not contain any introductory phrases or additional explanations.
 
@@ -741,27 +849,9 @@ async function navigator_summarize_dx(userId, question, conversation, context){
         llm: claude2,
       });
 
-      const chain_retry = chain.withRetry({
-        stopAfterAttempt: 3,
+      let response = await invokeWithBackoff(chain, {
+        input: question,
       });
-
-      
-      let response;
-      try {
-        response = await chain_retry.invoke({
-          input: question,
-        });
-      } catch (error) {
-        if (error.message.includes('Error 429')) {
-          console.log("Rate limit exceeded, waiting and retrying...");
-          await new Promise(resolve => setTimeout(resolve, 20000)); // Wait for 20 seconds
-          response = await chain_retry.invoke({
-            input: question,
-          });
-        } else {
-          throw error;
-        }
-      }
   
       // console.log(response);
       resolve(response);
@@ -777,11 +867,8 @@ async function navigator_summarize_dx(userId, question, conversation, context){
   });
 }
 
-async function categorize_docs(userId, content){
-  return new Promise(async function (resolve, reject) {
-    try {
-      systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
-        `You will be provided with a medical document (delimited with input XML tags).
+const categorizeSystemPrompt = SystemMessagePromptTemplate.fromTemplate(
+  `You will be provided with a medical document (delimited with input XML tags).
         Your task is to categorize the document into one of the following categories and extract ALL the relevant information that is present in the document (if any):
 
         - Clinical History
@@ -969,10 +1056,10 @@ async function categorize_docs(userId, content){
           "other": "Other relevant information about the document, can be anything that does not fit in the other categories"
         }}
         `
-      );
-      
-      humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-        `Here is the medical document to categorize and extract the relevant information:
+);
+
+const categorizeHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Here is the medical document to categorize and extract the relevant information:
 
         <input document>
         {doc}
@@ -982,33 +1069,69 @@ async function categorize_docs(userId, content){
 
         Output:
         `
-      );
+);
 
+// Documents longer than the 128k context are cut to this many tokens, leaving room for the instructions and the answer
+const maxDocumentTokens = 120000;
+
+// Same encoding as countTokens (which takes the NFKC form), done once for both the count and the cut.
+// text is only returned when the document had to be truncated
+function countAndTruncateTokens(normalizedText, maxTokens) {
+  const tokenizer = countTokens.getTokenizer();
+  try {
+    const encoded = tokenizer.encode(normalizedText, 'all');
+    if (encoded.length <= maxTokens) {
+      return { tokens: encoded.length, text: null };
+    }
+    return { tokens: encoded.length, text: new TextDecoder().decode(tokenizer.decode(encoded.slice(0, maxTokens))) };
+  } finally {
+    tokenizer.free();
+  }
+}
+
+// Both messages are static, the chat prompt is built once and only formatted per document
+const categorizeChatPrompt = ChatPromptTemplate.fromMessages([categorizeSystemPrompt, categorizeHumanPrompt]);
+
+async function categorize_docs(userId, content){
+  return new Promise(async function (resolve, reject) {
+    try {
       // Create the models
       const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
+      // Only the model chosen by the token count below is read, so only that one is built
+      const models = createModels(projectName);
 
       // Format and call the prompt to categorize each document
-      clean_doc = content.replace(/{/g, '{{').replace(/}/g, '}}');
+      let clean_doc = escapeTemplateBraces(content);
 
-      chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, humanMessagePrompt])
-      
-      const tokens = countTokens.countTokens(clean_doc);
+      // The tokenizer works on the NFKC form of the text (which can be longer than the original) and every token
+      // covers at least one of its bytes, so documents whose normalized form fits in the 32k budget skip the tokenizer
+      const normalizedDoc = clean_doc.normalize('NFKC');
+      const countsTokens = Buffer.byteLength(normalizedDoc, 'utf8') > 30000;
+      const counted = countsTokens ? countAndTruncateTokens(normalizedDoc, maxDocumentTokens) : null;
+      const tokens = counted ? counted.tokens : 0;
 
-      let selectedModel = tokens > 30000 ? azure128k : azure32k;
+      // The 32k deployment does not support JSON mode, its output still goes through the ``` cleanup below
+      let selectedModel = tokens > 30000 ? models.azure128kJson : models.azure32k;
       
-      console.log("Tokens: ", tokens, "Model: ", selectedModel);
+      insights.debug("Tokens: ", countsTokens ? tokens : "skipped", "Model: ", selectedModel);
+
+      // The call would be rejected as a whole, categorize the beginning of the document instead.
+      // The categorization is then partial, so it is reported also in production
+      if (counted && counted.text !== null) {
+        clean_doc = counted.text;
+        insights.error(`categorize_docs: document of ${tokens} tokens truncated to ${maxDocumentTokens} tokens (user ${userId})`);
+      }
       
       const categoryChain = new LLMChain({
-        prompt: chatPrompt,
+        prompt: categorizeChatPrompt,
         llm: selectedModel,
       });
 
-      const category = await categoryChain.call({
+      const category = await invokeWithBackoff(categoryChain, {
         doc: clean_doc,
       });
 
-      console.log(category.text);
+      insights.debug(category.text);
 
       // Try to parse the JSON object category, if error clean the ```
       let categoryJSON;
@@ -1022,7 +1145,7 @@ async function categorize_docs(userId, content){
         const cleanedData = category.text.replace(regex, '');
         categoryJSON = JSON.parse(cleanedData);
       }
-      console.log(categoryJSON);
+      insights.debug(categoryJSON);
       resolve(categoryJSON);
     } catch (error) {
       console.log("Error happened: ", error)
@@ -1036,11 +1159,8 @@ async function categorize_docs(userId, content){
   });
 }
 
-async function combine_categorized_docs(userId, context){
-  return new Promise(async function (resolve, reject) {
-    try {
-      systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
-        `You will be provided with a list of medical documents (delimited with input XML tags).
+const combineSystemPrompt = SystemMessagePromptTemplate.fromTemplate(
+  `You will be provided with a list of medical documents (delimited with input XML tags).
         Your task is to combine the information from all the documents into a single JSON object and output it.
         The documents will be in the following categories:
 
@@ -1056,10 +1176,10 @@ async function combine_categorized_docs(userId, context){
         You ALWAYS ONLY have to return a JSON object with the minimum common most relevant information of all the documents.
         Do not return anything outside the JSON brackets.
         `
-      );
-      
-      humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-        `Here are the medical documents to combine and extract the relevant information:
+);
+
+const combineHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Here are the medical documents to combine and extract the relevant information:
 
         <input documents>
         {doc}
@@ -1069,35 +1189,30 @@ async function combine_categorized_docs(userId, context){
 
         Output:
         `
-      );
+);
 
+const combineChatPrompt = ChatPromptTemplate.fromMessages([combineSystemPrompt, combineHumanPrompt]);
+
+async function combine_categorized_docs(userId, context){
+  return new Promise(async function (resolve, reject) {
+    try {
       // Create the models
       const projectName = `LITE - ${config.LANGSMITH_PROJECT} - ${userId}`;
-      let { azuregpt4, azure32k, claude2, openai128k, azure128k, azuregpt4o } = createModels(projectName);
+      let { azure128kJson } = createModels(projectName);
 
       // Format and call the prompt
-      let cleanPatientInfo = "";
-      let i = 1;
-      for (const doc of context) {
-        let docText = JSON.stringify(doc);
-        cleanPatientInfo += "<Complete Document " + i + ">\n" + docText + "</Complete Document " + i + ">\n";
-        i++;
-      }
-      
-      cleanPatientInfo = cleanPatientInfo.replace(/{/g, '{{').replace(/}/g, '}}');
-
-      chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, humanMessagePrompt])
+      let cleanPatientInfo = formatPatientContext(context);
 
       const categoryChain = new LLMChain({
-        prompt: chatPrompt,
-        llm: azure128k,
+        prompt: combineChatPrompt,
+        llm: azure128kJson,
       });
 
-      const category = await categoryChain.call({
+      const category = await invokeWithBackoff(categoryChain, {
         doc: cleanPatientInfo,
       });
 
-      console.log(category.text);
+      insights.debug(category.text);
 
       // Try to parse the JSON object category, if error clean the ```
       let categoryJSON;
@@ -1111,7 +1226,7 @@ async function combine_categorized_docs(userId, context){
         const cleanedData = category.text.replace(regex, '');
         categoryJSON = JSON.parse(cleanedData);
       }
-      console.log(categoryJSON);
+      insights.debug(categoryJSON);
       resolve(categoryJSON);
     } catch (error) {
       console.log("Error happened: ", error)
@@ -1125,20 +1240,12 @@ async function combine_categorized_docs(userId, context){
   });
 }
 
-async function translateSummary(lang, text) {
-  return new Promise(async function (resolve, reject) {
-    try {
-      // Create the models
-      const projectName = `TRANSLATE - ${config.LANGSMITH_PROJECT}`;
-      let { azure128k } = createModels(projectName); // Ajusta esto si necesitas otros modelos
-
-      // Format and call the prompt
-      const systemMessagePrompt = SystemMessagePromptTemplate.fromTemplate(
-        `You are an expert translator. Your task is to translate the given text into the specified language.`
-      );
+const translateSystemPrompt = SystemMessagePromptTemplate.fromTemplate(
+  `You are an expert translator. Your task is to translate the given text into the specified language.`
+);
 
-      const humanMessagePrompt = HumanMessagePromptTemplate.fromTemplate(
-        `Translate the following text into {input_language}:
+const translateHumanPrompt = HumanMessagePromptTemplate.fromTemplate(
+  `Translate the following text into {input_language}:
 
         {input_text}
 
@@ -1146,35 +1253,49 @@ async function translateSummary(lang, text) {
 
         Provide the translation only in the HTML format as follows:
         <div><h3>Title</h3><p>Translation goes here.</p></div>`
-      );
+);
 
-      const chatPrompt = ChatPromptTemplate.fromMessages([systemMessagePrompt, humanMessagePrompt]);
+function isTranslationHtml(text) {
+  return typeof text === 'string' && /<div[\s>]/i.test(text) && text.replace(/<[^>]*>/g, '').trim() !== '';
+}
 
+const translateChatPrompt = ChatPromptTemplate.fromMessages([translateSystemPrompt, translateHumanPrompt]);
+
+async function translateSummary(lang, text) {
+  return new Promise(async function (resolve, reject) {
+    try {
+      // Nothing to translate (empty or only html tags and whitespace), answer without calling the model
+      if (!text || text.replace(/<[^>]*>/g, '').trim() === '') {
+        resolve({ text: text || '' });
+        return;
+      }
+
+      // Create the models
+      const projectName = `TRANSLATE - ${config.LANGSMITH_PROJECT}`;
+      // Translation is a low-stakes task, gpt-4o is faster and cheaper than the gpt-4 turbo deployment
+      let { azuregpt4o } = createModels(projectName); // Ajusta esto si necesitas otros modelos
+
+      // Format and call the prompt
       const chain = new LLMChain({
-        prompt: chatPrompt,
-        llm: azure128k,
+        prompt: translateChatPrompt,
+        llm: azuregpt4o,
       });
 
-      const chain_retry = chain.withRetry({
-        stopAfterAttempt: 3,
-      });
+      // The same summary translated to the same language is served from the cache
+      const cacheKey = llmcache.getKey([llmCacheVersion, 'translateSummary', 'gpt-4o', lang, text]);
+      const cachedText = await llmcache.get(cacheKey);
 
       let response;
-      try {
-        response = await chain_retry.invoke({
+      if (cachedText !== null) {
+        response = { text: cachedText };
+      } else {
+        response = await invokeWithBackoff(chain, {
           input_language: lang,
           input_text: text,
         });
-      } catch (error) {
-        if (error.message.includes('Error 429')) {
-          console.log("Rate limit exceeded, waiting and retrying...");
-          await new Promise(resolve => setTimeout(resolve, 20000)); // Wait for 20 seconds
-          response = await chain_retry.invoke({
-            input_language: lang,
-            input_text: text,
-          });
-        } else {
-          throw error;
+        // Only translations in the requested html shape are cached, anything else is asked again next time
+        if (isTranslationHtml(response.text)) {
+          await llmcache.set(cacheKey, response.text);
         }
       }
 
@@ -0,0 +1,125 @@
+'use strict'
+
+const config = require('../config')
+const crypto = require('crypto')
+const fs = require('fs-extra')
+const path = require('path')
+
+// The responses hold patient information, so they only go to disk when a private folder is configured
+// (LLM_CACHE_DIR). One JSON file per prompt hash, readable only by the server user
+const cacheDir = config.LLM_CACHE_DIR || null;
+// Entries expire after a week, expired files are removed by a sweep at most once an hour
+const ttlMs = 7 * 24 * 60 * 60 * 1000;
+const sweepIntervalMs = 60 * 60 * 1000;
+let lastSweep = 0;
+// The most recent entries are also kept in memory (Map keeps insertion order, oldest first),
+// up to a total size since a single entry can be a whole summary html
+const memoryMaxBytes = 32 * 1024 * 1024;
+const memory = new Map();
+let memoryBytes = 0;
+
+function isExpired(savedAt) {
+  return !savedAt || Date.now() - savedAt > ttlMs;
+}
+
+function forget(key) {
+  const entry = memory.get(key);
+  if (entry) {
+    memoryBytes -= entry.bytes;
+    memory.delete(key);
+  }
+}
+
+function remember(key, entry) {
+  forget(key);
+  if (entry.bytes === undefined) {
+    const value = entry.value;
+    entry.bytes = Buffer.byteLength(typeof value === 'string' ? value : JSON.stringify(value), 'utf8');
+  }
+  memory.set(key, entry);
+  memoryBytes += entry.bytes;
+  while (memoryBytes > memoryMaxBytes) {
+    forget(memory.keys().next().value);
+  }
+}
+
+function getKey(parts) {
+  return crypto.createHash('sha256').update(JSON.stringify(parts)).digest('hex');
+}
+
+// Only files the cache writes itself (<sha256>.json) are swept, anything else in the folder is left alone
+const entryFileRegex = /^[0-9a-f]{64}\.json$/;
+
+async function sweep() {
+  lastSweep = Date.now();
+  let files;
+  try {
+    files = await fs.readdir(cacheDir);
+  } catch (error) {
+    console.log("Error sweeping LLM cache: ", error)
+    return;
+  }
+  for (const file of files) {
+    if (!entryFileRegex.test(file)) {
+      continue;
+    }
+    const filePath = path.join(cacheDir, file);
+    try {
+      const stats = await fs.lstat(filePath);
+      if (stats.isFile() && isExpired(stats.mtimeMs)) {
+        await fs.unlink(filePath);
+      }
+    } catch (error) {
+      // The file may have been removed in the meantime, go on with the rest
+      console.log("Error sweeping LLM cache file: ", file, error)
+    }
+  }
+}
+
+async function get(key) {
+  const entry = memory.get(key);
+  if (entry) {
+    if (!isExpired(entry.savedAt)) {
+      remember(key, entry);
+      return entry.value;
+    }
+    forget(key);
+  }
+  if (!cacheDir) {
+    return null;
+  }
+  try {
+    const cached = await fs.readJson(path.join(cacheDir, key + '.json'));
+    if (isExpired(cached.savedAt)) {
+      return null;
+    }
+    remember(key, cached);
+    return cached.value;
+  } catch (error) {
+    // Missing or unreadable entries are just a cache miss
+    return null;
+  }
+}
+
+async function set(key, value) {
+  const entry = { savedAt: Date.now(), value: value };
+  remember(key, entry);
+  if (!cacheDir) {
+    return;
+  }
+  try {
+    await fs.ensureDir(cacheDir, 0o700);
+    await fs.writeJson(path.join(cacheDir, key + '.json'), { savedAt: entry.savedAt, value: entry.value }, { mode: 0o600 });
+    if (Date.now() - lastSweep > sweepIntervalMs) {
+      sweep();
+    }
+  } catch (error) {
+    console.log("Error writing LLM cache: ", error)
+  }
+}
+
+module.exports = {
+  getKey,
+  get,
+  set
+}
@@ -1,24 +1,27 @@
-const { Configuration, OpenAIApi } = require("openai");
 const { OpenAIClient, AzureKeyCredential } = require("@azure/openai");
 const config = require('../config')
 const insights = require('../services/insights')
-const configuration = new Configuration({
-  apiKey: config.OPENAI_API_KEY,
-});
-const openai = new OpenAIApi(configuration);
 const langchain = require('../services/langchain')
 
 const endpoint = config.AZURE_OPENAI_ENDPOINT;
 const azureApiKey = config.OPENAI_API_KEY
+// One client for every request, so its connections are reused instead of opening a new one per call
+let client = null;
+
+function getClient() {
+  if (client == null) {
+    client = new OpenAIClient(endpoint, new AzureKeyCredential(azureApiKey));
+  }
+  return client;
+}
 
 function callOpenAiContext (req, res){
   var content = req.body;
 
   (async () => {
     try {
-      const client = new OpenAIClient(endpoint, new AzureKeyCredential(azureApiKey));
     const deploymentId = "nav29turbo35";
-    const result = await client.getChatCompletions({
+    const result = await getClient().getChatCompletions({
         deploymentName: deploymentId, 
         messages: content,
         temperature: 0,
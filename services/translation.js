@@ -6,6 +6,15 @@ const deepl = require('deepl-node');
 const insights = require('../services/insights')
 const deeplApiKey = config.DEEPL_API_KEY;
 const langchain = require('../services/langchain')
+// Shared DeepL translator, keeps its HTTP connections alive between translations
+let translator = null;
+
+function getTranslator() {
+  if (translator == null) {
+    translator = new deepl.Translator(deeplApiKey);
+  }
+  return translator;
+}
 
 function getDetectLanguage(req, res) {
     var jsonText = req.body;
@@ -57,11 +66,7 @@ function getTranslationDictionary2 (text, source_lang){
       insights.error(error);
       reject(error)
     }
-    if(body=='Missing authentication token.'){
-      resolve(body)
-    }else{
-      resolve(body)
-    }
+    resolve(body)
   });
 });
 }
@@ -88,13 +93,13 @@ function getTranslationDictionaryInvert (req, res){
 async function getdeeplTranslationDictionaryInvert (req, res){
   var lang = req.body.lang;
   var info = req.body.info;
-  var deepl_code = await getDeeplCode(lang);
+  var deepl_code = getDeeplCode(lang);
   if (deepl_code == null) {
     const inverseTranslatedText = await getTranslationDictionaryInvertMicrosoft2(info, lang);
     let source_text = inverseTranslatedText[0].translations[0].text
     res.status(200).send({text: source_text})
   } else {
-    if(info[0].Text == null || info[0].Text == undefined || info[0].Text == ''){
+    if(!info[0].Text){
       res.status(200).send({text: ''})
     }else{
       let source_text = await deepLtranslate(info[0].Text, deepl_code);
@@ -107,23 +112,14 @@ async function getdeeplTranslationDictionaryInvert (req, res){
 async function getTranslationDictionaryInvert2 (req, res){
   var lang = req.body.lang;
   var info = req.body.info;
-  var deepl_code = await getDeeplCode(lang);
+  var deepl_code = getDeeplCode(lang);
   if (deepl_code == null) {
     const inverseTranslatedText = await getTranslationDictionaryInvertMicrosoft2(info, lang);
     let source_text = inverseTranslatedText[0].translations[0].text
     res.status(200).send({text: source_text})
   } else {
-     // Realiza una traducción para cada fragmento de texto
-    let translatedLines = [];
-    for(let item of info){
-      if(item.Text == null || item.Text == undefined || item.Text == ''){
-        translatedLines.push('');
-      }else{
-        let source_text = await deepLtranslate2(item.Text, deepl_code);
-        translatedLines.push(source_text);
-      }
-      
-    }
+     // Traduce todos los fragmentos de texto en una sola llamada
+    let translatedLines = await deepLtranslateBatch(info.map(item => item.Text), deepl_code);
     res.status(200).send(translatedLines);
   }
 }
@@ -139,11 +135,7 @@ function getTranslationDictionaryInvertMicrosoft2 (text, source_lang){
       insights.error(error);
       reject(error)
     }
-    if(body=='Missing authentication token.'){
-      resolve(body)
-    }else{
-      resolve(body)
-    }
+    resolve(body)
 
   });
 });
@@ -285,32 +277,62 @@ function getTranslationSegments(req, res){
     "zu": null
 };
 
-async function getDeeplCode(msCode) {
+// Plain lookup, there is nothing asynchronous about it
+function getDeeplCode(msCode) {
     return langDict[msCode] || null;
 }
 
 async function deepLtranslate(text, target) {
-  if(text == null || text == undefined || text == ''){
+  if(!text){
     return '';
   }else{
-    const translator = new deepl.Translator(deeplApiKey);
-    const result = await translator.translateText(text, null, target, { tagHandling: 'html' });
+    const result = await getTranslator().translateText(text, null, target, { tagHandling: 'html' });
     return result.text;
   }
     
 }
 
-async function deepLtranslate2(text, target) {
-  if(text == null || text == undefined || text == ''){
-    return '';
-  }else{
-    const translator = new deepl.Translator(deeplApiKey);
-    const result = await translator.translateText(text, null, target, {
-      tagHandling: 'html',
-    });
-    return result.text;
+const deeplMaxTexts = 50;
+// DeepL also rejects request bodies over 128 KiB. Texts go form-encoded, so each one is measured encoded,
+// leaving some room for the other parameters
+const deeplMaxBytes = 120 * 1024;
+const deeplMaxConcurrent = 4;
+
+async function deepLtranslateBatch(texts, target) {
+  // DeepL does not accept empty texts, so only the non-empty ones are sent and the rest stay ''
+  let translatedLines = texts.map(() => '');
+  // DeepL takes at most 50 texts per request, bigger arrays go in chunks (also cut by size)
+  // with a few requests in flight at a time. A single text over the size limit goes alone
+  let chunks = [];
+  let chunk = null;
+  texts.forEach((text, index) => {
+    if(text){
+      // Encoded text plus its '&text=' key
+      const bytes = encodeURIComponent(text).length + 6;
+      if (!chunk || chunk.indexes.length >= deeplMaxTexts || chunk.bytes + bytes > deeplMaxBytes) {
+        chunk = { indexes: [], texts: [], bytes: 0 };
+        chunks.push(chunk);
+      }
+      chunk.indexes.push(index);
+      chunk.texts.push(text);
+      chunk.bytes += bytes;
+    }
+  });
+  let nextChunk = 0;
+  async function translateChunks() {
+    while (nextChunk < chunks.length) {
+      const current = chunks[nextChunk++];
+      const results = await getTranslator().translateText(current.texts, null, target, {
+        tagHandling: 'html',
+      });
+      results.forEach((result, i) => {
+        translatedLines[current.indexes[i]] = result.text;
+      });
+    }
   }
- 
+  const workers = Math.min(deeplMaxConcurrent, chunks.length);
+  await Promise.all(Array.from({ length: workers }, translateChunks));
+  return translatedLines;
 }
 
 async function getTranslationIA(req, res){
@@ -330,6 +352,7 @@ module.exports = {
   getTranslationSegments,
   getDeeplCode,
   deepLtranslate,
+  deepLtranslateBatch,
   getdeeplTranslationDictionaryInvert,
   getTranslationDictionaryInvert2,
   getTranslationIA